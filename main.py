@@ -4,14 +4,19 @@ from fastapi.security import APIKeyHeader
 from pydantic import BaseModel
 import shutil
 import os
+import stat
 import asyncio
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import httpx
 import ulid
-from typing import List, Optional, Dict
+from cachetools import TTLCache
+from typing import List, Optional, Dict, NamedTuple
 
-from engine import QwenTTSEngine
-from video_concat import concat_videos, merge_video_audio
+from engine import QwenTTSEngine, write_wav
+from model_server import RemoteTTSEngine, RemoteJobStore
+from video_concat import concat_videos, merge_video_audio, reaper_loop
 
 # -- Configuration --
 VOICE_DIR = "/voices"
@@ -20,6 +25,11 @@ FINAL_OUTPUT_DIR = "/final_outputs"
 os.makedirs(VOICE_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(FINAL_OUTPUT_DIR, exist_ok=True)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+JOB_STORE_MAXSIZE = int(os.getenv("JOB_STORE_MAXSIZE", "10000"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", str(24 * 60 * 60)))
+# When set, the model and job store live in a shared model_server.py process
+TTS_MODEL_SOCKET = os.getenv("TTS_MODEL_SOCKET")
 
 # -- Security Configuration --
 API_KEY_NAME = "x-api-key"
@@ -44,19 +54,106 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
     )
 
 app = FastAPI(title="Qwen3-TTS RTX 3060 Service")
+logger = logging.getLogger("TTS_API")
+
+# -- Batching Configuration --
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_WINDOW_SECONDS = float(os.getenv("BATCH_WINDOW_MS", "10")) / 1000
+
+class PendingGeneration(NamedTuple):
+    task_id: str
+    text: str
+    voice_id: str
+    ref_audio_path: str
+    language: str
+    future: asyncio.Future
 
 # -- Global State --
-inference_lock = asyncio.Lock()
+generation_queue: "asyncio.Queue[PendingGeneration]" = asyncio.Queue()
+batch_worker_task = None
+reaper_task = None
 tts_engine = None
+# WAV encoding runs here rather than on the inference thread
+wav_writer_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="wav-writer")
 
-# In-memory Job Store
+# In-memory Job Store, bounded in size and age so finished jobs don't accumulate forever.
+# Replaced by a RemoteJobStore at startup when a model server is used.
 # Structure: { task_id: { "status": str, "filename": str|None, "error": str|None } }
-JOBS: Dict[str, dict] = {}
+JOBS = TTLCache(maxsize=JOB_STORE_MAXSIZE, ttl=JOB_TTL_SECONDS)
+
+async def get_job(task_id: str) -> Optional[dict]:
+    """Reads a job. Remote stores are socket round trips, so they run off the event loop."""
+    if isinstance(JOBS, RemoteJobStore):
+        return await asyncio.to_thread(JOBS.get, task_id)
+    return JOBS.get(task_id)
+
+async def put_job(task_id: str, job: dict):
+    if isinstance(JOBS, RemoteJobStore):
+        await asyncio.to_thread(JOBS.__setitem__, task_id, job)
+    else:
+        JOBS[task_id] = job
+
+async def update_job(task_id: str, **fields):
+    """Updates a job's state, ignoring jobs that already expired from the store."""
+    job = await get_job(task_id)
+    if job is not None:
+        job.update(fields)
+        # Written back so remote stores, which return copies, see the change
+        await put_job(task_id, job)
+
+# voice_id -> sample path. Samples are stored as {voice_id}{ext}, so lookups are O(1)
+VOICE_INDEX: Dict[str, str] = {}
+# VOICE_DIR's mtime when VOICE_INDEX was last scanned; files added or removed change it
+voice_dir_mtime_ns: Optional[int] = None
+
+def scan_voice_dir() -> Dict[str, str]:
+    """Builds the voice index with a single directory scan."""
+    index = {}
+    with os.scandir(VOICE_DIR) as entries:
+        for entry in entries:
+            if entry.is_file():
+                index[os.path.splitext(entry.name)[0]] = entry.path
+    return index
+
+async def refresh_voice_index():
+    """Rescans VOICE_DIR only if its mtime changed since the last scan."""
+    global voice_dir_mtime_ns
+    # Stat before scanning, so a change made during the scan triggers another one
+    mtime_ns = (await asyncio.to_thread(os.stat, VOICE_DIR)).st_mtime_ns
+    if mtime_ns == voice_dir_mtime_ns:
+        return
+    index = await asyncio.to_thread(scan_voice_dir)
+    VOICE_INDEX.clear()
+    VOICE_INDEX.update(index)
+    voice_dir_mtime_ns = mtime_ns
+
+async def resolve_voice(voice_id: str) -> Optional[str]:
+    """Returns the sample path for a voice, rescanning on a miss if the directory changed out of band."""
+    path = VOICE_INDEX.get(voice_id)
+    if path is None:
+        await refresh_voice_index()
+        path = VOICE_INDEX.get(voice_id)
+    return path
+
+def list_voice_files() -> List[tuple]:
+    """Returns (filename, size) for every sample; scandir supplies the size without an extra stat."""
+    with os.scandir(VOICE_DIR) as entries:
+        return [(entry.name, entry.stat().st_size) for entry in entries if entry.is_file()]
 
 @app.on_event("startup")
 async def startup_event():
-    global tts_engine
-    tts_engine = QwenTTSEngine()
+    global tts_engine, batch_worker_task, reaper_task, JOBS
+    await refresh_voice_index()
+    if TTS_MODEL_SOCKET:
+        # Waits for the model server to come up, so keep it off the event loop
+        tts_engine = await asyncio.to_thread(RemoteTTSEngine, TTS_MODEL_SOCKET)
+        JOBS = RemoteJobStore(tts_engine.client)
+    else:
+        tts_engine = QwenTTSEngine()
+        if tts_engine.compiled:
+            await asyncio.get_running_loop().run_in_executor(None, tts_engine.warmup)
+    batch_worker_task = asyncio.create_task(batch_worker())
+    reaper_task = asyncio.create_task(reaper_loop(OUTPUT_DIR))
 
 # -- Data Models --
 class GenerationRequest(BaseModel):
@@ -110,44 +207,90 @@ class MergeVideoAudioResponse(BaseModel):
     size_bytes: int
 
 # -- Background Worker --
+async def batch_worker():
+    """
+    Single consumer of the generation queue. Collects jobs that arrive within a short
+    window and runs those sharing a reference voice as one generate_voice_clone call,
+    one batch at a time.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        pending = [await generation_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(pending) < BATCH_MAX_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(generation_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Language is passed per text, so only the reference voice has to match
+        groups: Dict[str, list] = {}
+        for job in pending:
+            groups.setdefault(job.voice_id, []).append(job)
+
+        for voice_id, jobs in groups.items():
+            await run_batch(voice_id, jobs)
+
+async def run_batch(voice_id: str, jobs: List[PendingGeneration]):
+    """Runs one batch on the engine and resolves its jobs' futures."""
+    try:
+        for job in jobs:
+            await update_job(job.task_id, status="processing")
+        # Run blocking inference in threadpool
+        loop = asyncio.get_running_loop()
+        wavs, sr = await loop.run_in_executor(
+            None,
+            tts_engine.clone_voice_batch,
+            [job.text for job in jobs],
+            voice_id,
+            jobs[0].ref_audio_path,
+            [job.language for job in jobs]
+        )
+    except Exception as e:
+        for job in jobs:
+            job.future.set_exception(e)
+        return
+    for job, wav in zip(jobs, wavs):
+        job.future.set_result((wav, sr))
+
 async def process_generation_task(task_id: str, text: str, voice_id: str, language: str):
     """
-    Background worker that acquires the GPU lock and runs inference.
+    Background task that resolves the voice, waits for its batch and writes the result.
     """
     # 1. Resolve Voice File
-    ref_audio_path = None
-    for filename in os.listdir(VOICE_DIR):
-        if filename.startswith(voice_id):
-            ref_audio_path = os.path.join(VOICE_DIR, filename)
-            break
-            
+    ref_audio_path = await resolve_voice(voice_id)
     if not ref_audio_path:
-        JOBS[task_id]["status"] = "failed"
-        JOBS[task_id]["error"] = "Voice ID not found"
+        await update_job(task_id, status="failed", error="Voice ID not found")
         return
 
-    # 2. Wait for GPU Availability
-    async with inference_lock:
+    # 2. Queue for the batch worker and wait for the GPU result
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    await generation_queue.put(PendingGeneration(task_id, text, voice_id, ref_audio_path, language, future))
+    try:
+        wav, sr = await future
+        # 3. Encode to disk off the inference path
+        output_filename = await loop.run_in_executor(wav_writer_pool, write_wav, wav, sr, OUTPUT_DIR)
+        await update_job(task_id, status="completed", filename=output_filename)
+    except Exception as e:
         try:
-            JOBS[task_id]["status"] = "processing"
-            
-            # Run blocking inference in threadpool
-            loop = asyncio.get_running_loop()
-            output_filename = await loop.run_in_executor(
-                None,
-                tts_engine.clone_voice,
-                text,
-                ref_audio_path,
-                OUTPUT_DIR,
-                language
-            )
-            
-            JOBS[task_id]["status"] = "completed"
-            JOBS[task_id]["filename"] = output_filename
-            
-        except Exception as e:
-            JOBS[task_id]["status"] = "failed"
-            JOBS[task_id]["error"] = str(e)
+            await update_job(task_id, status="failed", error=str(e))
+        except Exception as store_error:
+            logger.error(f"Could not record failure of task {task_id}: {store_error}")
+
+async def stat_file(path: str) -> Optional[os.stat_result]:
+    """
+    Stats a file off the event loop. The result is handed to FileResponse so it
+    doesn't stat again before sendfile; returns None if it isn't a regular file.
+    """
+    try:
+        file_stat = await asyncio.to_thread(os.stat, path)
+    except FileNotFoundError:
+        return None
+    return file_stat if stat.S_ISREG(file_stat.st_mode) else None
 
 # -- Endpoints --
 
@@ -156,14 +299,15 @@ async def generate_audio(req: GenerationRequest, background_tasks: BackgroundTas
     """
     Submits a generation job. Returns immediately with a task_id.
     """
-    task_id = str(uuid.uuid4())
+    # ULIDs sort lexicographically by creation time, so jobs can be ordered without a sort key
+    task_id = str(ulid.new())
     
     # Initialize Job State
-    JOBS[task_id] = {
+    await put_job(task_id, {
         "status": "queued",
         "filename": None,
         "error": None
-    }
+    })
     
     # Add to background queue
     background_tasks.add_task(
@@ -185,10 +329,9 @@ async def get_task_status(task_id: str):
     """
     Checks the status of a generation task.
     """
-    if task_id not in JOBS:
+    job = await get_job(task_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Task ID not found")
-        
-    job = JOBS[task_id]
     
     response = TaskStatus(
         task_id=task_id,
@@ -207,22 +350,23 @@ async def download_audio_endpoint(task_id: str):
     """
     Downloads the audio for a completed task.
     """
-    if task_id not in JOBS:
+    job = await get_job(task_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Task ID not found")
-        
-    job = JOBS[task_id]
     
     if job["status"]!= "completed":
         raise HTTPException(status_code=400, detail="Task not completed yet")
         
     file_path = os.path.join(OUTPUT_DIR, job["filename"])
-    if not os.path.exists(file_path):
+    file_stat = await stat_file(file_path)
+    if file_stat is None:
         raise HTTPException(status_code=404, detail="File lost on server")
     
     return FileResponse(
         path=file_path,
         media_type="audio/wav",
-        filename=f"qwen_tts_{task_id}.wav"
+        filename=f"qwen_tts_{task_id}.wav",
+        stat_result=file_stat
     )
 
 @app.post("/voices/upload", response_model=VoiceMetadata, dependencies=[Depends(get_api_key)])
@@ -243,6 +387,8 @@ async def upload_voice_sample(file: UploadFile = File(...)):
             shutil.copyfileobj(file.file, buffer)
     except Exception as e:
         raise HTTPException(status_code=500, detail="File write failed")
+
+    VOICE_INDEX[voice_id] = file_path
         
     return VoiceMetadata(
         voice_id=voice_id,
@@ -254,32 +400,35 @@ async def upload_voice_sample(file: UploadFile = File(...)):
 async def list_voices():
     """Lists all available voice samples."""
     results = []
-    for filename in os.listdir(VOICE_DIR):
-        path = os.path.join(VOICE_DIR, filename)
-        if os.path.isfile(path):
-            vid = os.path.splitext(filename)[0]
-            results.append(VoiceMetadata(
-                voice_id=vid,
-                filename=filename,
-                size_bytes=os.path.getsize(path)
-            ))
+    for filename, size_bytes in await asyncio.to_thread(list_voice_files):
+        vid = os.path.splitext(filename)[0]
+        results.append(VoiceMetadata(
+            voice_id=vid,
+            filename=filename,
+            size_bytes=size_bytes
+        ))
     return results
 
 @app.delete("/voices/{voice_id}", dependencies=[Depends(get_api_key)])
 async def delete_voice_sample(voice_id: str):
     """Deletes a specific voice sample."""
-    target_path = None
-    for filename in os.listdir(VOICE_DIR):
-        if filename.startswith(voice_id):
-            target_path = os.path.join(VOICE_DIR, filename)
-            break
+    target_path = await resolve_voice(voice_id)
+    VOICE_INDEX.pop(voice_id, None)
+    await asyncio.to_thread(tts_engine.invalidate_voice, voice_id)
     
-    if target_path and os.path.exists(target_path):
-        os.remove(target_path)
-        return {"status": "deleted", "voice_id": voice_id}
+    if target_path:
+        try:
+            await asyncio.to_thread(os.remove, target_path)
+            return {"status": "deleted", "voice_id": voice_id}
+        except FileNotFoundError:
+            pass
     
     raise HTTPException(status_code=404, detail="Voice ID not found")
 
+def _remove_partial_download(file_path: str):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
 @app.post("/videos/download", response_model=VideoDownloadResponse, dependencies=[Depends(get_api_key)])
 async def download_video(req: VideoDownloadRequest):
     """Downloads a video file from a URL into the specified project folder."""
@@ -295,17 +444,34 @@ async def download_video(req: VideoDownloadRequest):
 
     file_path = os.path.join(project_path, url_filename)
 
+    completed = False
     try:
         async with httpx.AsyncClient(follow_redirects=True) as client:
-            response = await client.get(req.url)
-            response.raise_for_status()
-
-            with open(file_path, "wb") as f:
-                f.write(response.content)
+            # Stream to disk in 1 MiB chunks instead of holding the whole video in memory
+            async with client.stream("GET", req.url) as response:
+                response.raise_for_status()
+
+                with open(file_path, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                    content_length = response.headers.get("content-length")
+                    if content_length and content_length.isdigit() and hasattr(os, "posix_fallocate"):
+                        try:
+                            os.posix_fallocate(f.fileno(), 0, int(content_length))
+                        except OSError:
+                            pass
+
+                    async for chunk in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                    # Drop any preallocated tail if the body was shorter than advertised
+                    f.truncate()
+        completed = True
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=502, detail=f"Remote server returned {e.response.status_code}")
     except httpx.RequestError as e:
         raise HTTPException(status_code=502, detail=f"Download failed: {str(e)}")
+    finally:
+        # Any failure (including disk full or a broken stream) must not leave a preallocated file behind
+        if not completed:
+            _remove_partial_download(file_path)
 
     return VideoDownloadResponse(
         status="downloaded",
@@ -350,8 +516,7 @@ async def merge_video_audio_endpoint(req: MergeVideoAudioRequest):
     output_path = os.path.join(FINAL_OUTPUT_DIR, filename)
 
     try:
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, merge_video_audio, req.video_path, req.audio_path, output_path)
+        await merge_video_audio(req.video_path, req.audio_path, output_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Merge failed: {str(e)}")
 
@@ -366,11 +531,13 @@ async def merge_video_audio_endpoint(req: MergeVideoAudioRequest):
 async def download_final_video(filename: str):
     """Downloads a file from final_outputs."""
     file_path = os.path.join(FINAL_OUTPUT_DIR, filename)
-    if not os.path.exists(file_path):
+    file_stat = await stat_file(file_path)
+    if file_stat is None:
         raise HTTPException(status_code=404, detail="File not found")
 
     return FileResponse(
         path=file_path,
         media_type="video/mp4",
-        filename=filename
+        filename=filename,
+        stat_result=file_stat
     )
\ No newline at end of file
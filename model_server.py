@@ -0,0 +1,179 @@
+"""
+Runs QwenTTSEngine in a single dedicated process so several uvicorn workers can share
+one copy of the model on the GPU instead of each loading its own.
+
+HTTP workers talk to it over a Unix socket using RemoteTTSEngine, which exposes the same
+methods as QwenTTSEngine. The server also holds the job store (RemoteJobStore), so a task
+submitted through one worker can be polled through any other.
+
+Both sides must share TTS_MODEL_AUTHKEY; connections are authenticated before any
+request is unpickled.
+
+Usage:
+    TTS_MODEL_SOCKET=/tmp/qwen-tts.sock TTS_MODEL_AUTHKEY=... python model_server.py
+    TTS_MODEL_SOCKET=/tmp/qwen-tts.sock TTS_MODEL_AUTHKEY=... uvicorn main:app --workers 2
+"""
+import logging
+import os
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import List, Optional
+
+from cachetools import TTLCache
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("TTS_ModelServer")
+
+JOB_STORE_MAXSIZE = int(os.getenv("JOB_STORE_MAXSIZE", "10000"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+def _authkey() -> bytes:
+    authkey = os.getenv("TTS_MODEL_AUTHKEY")
+    if not authkey:
+        raise RuntimeError("TTS_MODEL_AUTHKEY must be set to use the model server")
+    return authkey.encode()
+
+
+def serve(socket_path: str):
+    """Loads the model once and serves engine and job-store calls, one thread per connection."""
+    from engine import QwenTTSEngine
+
+    authkey = _authkey()
+
+    engine = QwenTTSEngine()
+    if engine.compiled:
+        engine.warmup()
+
+    jobs = TTLCache(maxsize=JOB_STORE_MAXSIZE, ttl=JOB_TTL_SECONDS)
+    jobs_lock = threading.Lock()
+
+    def get_job(task_id: str) -> Optional[dict]:
+        with jobs_lock:
+            job = jobs.get(task_id)
+            return dict(job) if job is not None else None
+
+    def put_job(task_id: str, job: dict):
+        with jobs_lock:
+            jobs[task_id] = job
+
+    handlers = {
+        "clone_voice_batch": engine.clone_voice_batch,
+        "invalidate_voice": engine.invalidate_voice,
+        "get_job": get_job,
+        "put_job": put_job,
+    }
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # Requests are pickled, so the socket is created owner-only and every client must
+    # pass the authkey handshake
+    old_umask = os.umask(0o177)
+    try:
+        listener = Listener(socket_path, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(old_umask)
+    logger.info(f"Model server listening on {socket_path}")
+
+    while True:
+        try:
+            conn = listener.accept()
+        except AuthenticationError:
+            logger.warning("Rejected model server connection with a bad authkey")
+            continue
+        threading.Thread(target=_handle_connection, args=(conn, handlers), daemon=True).start()
+
+
+def _handle_connection(conn: Connection, handlers: dict):
+    with conn:
+        while True:
+            try:
+                method, args = conn.recv()
+            except EOFError:
+                return
+            try:
+                conn.send(("ok", handlers[method](*args)))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class ModelServerClient:
+    """
+    Calls the model server over its Unix socket, with one connection per calling thread.
+    Calls block, so callers on the event loop must run them in a thread.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.authkey = _authkey()
+        self._local = threading.local()
+
+    def wait_until_ready(self, timeout: float):
+        """Blocks until the server accepts connections; it may still be loading the model."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._connection()
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(1)
+
+    def _connection(self) -> Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # After startup a missing server fails the call rather than stalling it
+            conn = Client(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def call(self, method: str, *args):
+        conn = self._connection()
+        try:
+            conn.send((method, args))
+            status, result = conn.recv()
+        except (EOFError, OSError):
+            # Drop the broken connection so the next call reconnects
+            self._local.conn = None
+            conn.close()
+            raise
+        if status == "error":
+            raise RuntimeError(result)
+        return result
+
+
+class RemoteTTSEngine:
+    """Drop-in replacement for QwenTTSEngine that forwards calls to the model server."""
+
+    def __init__(self, socket_path: str, connect_timeout: float = 600):
+        self.client = ModelServerClient(socket_path)
+        self.client.wait_until_ready(connect_timeout)
+
+    def clone_voice_batch(self, texts: List[str], voice_id: str, ref_audio_path: str, languages: List[str]):
+        return self.client.call("clone_voice_batch", texts, voice_id, ref_audio_path, languages)
+
+    def invalidate_voice(self, voice_id: str):
+        self.client.call("invalidate_voice", voice_id)
+
+
+class RemoteJobStore:
+    """
+    The subset of the TTLCache interface main.py uses for JOBS, backed by the model server.
+    Every call is a socket round trip; main.py runs them through asyncio.to_thread.
+    """
+
+    def __init__(self, client: ModelServerClient):
+        self.client = client
+
+    def get(self, task_id: str) -> Optional[dict]:
+        return self.client.call("get_job", task_id)
+
+    def __setitem__(self, task_id: str, job: dict):
+        self.client.call("put_job", task_id, job)
+
+
+if __name__ == "__main__":
+    serve(os.getenv("TTS_MODEL_SOCKET", "/tmp/qwen-tts.sock"))
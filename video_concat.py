@@ -1,15 +1,25 @@
-from moviepy import VideoFileClip, AudioFileClip, concatenate_videoclips
+from moviepy import VideoFileClip, concatenate_videoclips
+import asyncio
+import heapq
+import json
 import os
 import shutil
+import subprocess
+import tempfile
 import threading
+import time
+from typing import List, Optional, Tuple
 
 
 VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv')
+# Seconds before a failed NVENC probe is retried; a successful probe is kept for the process
+NVENC_REPROBE_SECONDS = 300
 
 
 def concat_videos(folder: str, output_path: str) -> str:
     """
     Concatenates all video files in a folder into one, sorted by filename.
+    Files with matching stream parameters are stream-copied; otherwise they are re-encoded.
     After completion, schedules the folder for deletion after 2 days.
 
     Args:
@@ -27,38 +37,237 @@ def concat_videos(folder: str, output_path: str) -> str:
     if len(files) < 2:
         raise ValueError(f"Need at least 2 video files in folder, found {len(files)}")
 
+    paths = [os.path.join(folder, f) for f in files]
+
+    # Identical stream parameters can be joined without decoding a single frame
+    first_params = _probe_stream_params(paths[0])
+    if all(_probe_stream_params(p) == first_params for p in paths[1:]):
+        try:
+            _concat_stream_copy(paths, output_path)
+        except RuntimeError:
+            # Some matching codecs (e.g. vorbis, flv1) can't be muxed into the output container
+            _concat_reencode(paths, output_path)
+    else:
+        _concat_reencode(paths, output_path)
+
+    _schedule_folder_deletion(folder, delay_seconds=2 * 24 * 60 * 60)
+
+    return output_path
+
+
+def _concat_stream_copy(paths: List[str], output_path: str):
+    """Joins files with the ffmpeg concat demuxer, copying packets as-is."""
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as list_file:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped}'\n")
+
+    try:
+        _run_ffmpeg([
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "concat", "-safe", "0", "-i", list_file.name,
+            "-c", "copy", output_path,
+        ])
+    finally:
+        os.remove(list_file.name)
+
+
+def _concat_reencode(paths: List[str], output_path: str):
+    """Fallback for clips with differing codecs/parameters: decode and re-encode."""
     clips = []
     try:
-        for f in files:
-            clips.append(VideoFileClip(os.path.join(folder, f)))
+        for path in paths:
+            clips.append(VideoFileClip(path))
 
         final = concatenate_videoclips(clips)
-        final.write_videofile(output_path, logger=None)
+        encoder = _video_encoder()
+        try:
+            final.write_videofile(output_path, codec=encoder, logger=None)
+        except OSError:
+            # NVENC can still fail at runtime, e.g. when the GPU's session limit is reached
+            if encoder == "libx264":
+                raise
+            final.write_videofile(output_path, codec="libx264", logger=None)
         final.close()
     finally:
         for clip in clips:
             clip.close()
 
-    _schedule_folder_deletion(folder, delay_seconds=2 * 24 * 60 * 60)
 
-    return output_path
+def _probe_stream_params(path: str) -> List[dict]:
+    """Returns the codec parameters that must match for a stream-copy concat."""
+    result = _run_ffmpeg([
+        "ffprobe", "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name,profile,width,height,pix_fmt,r_frame_rate,sample_fmt,sample_rate,channels",
+        "-of", "json", path,
+    ])
+    return json.loads(result.stdout).get("streams", [])
+
+
+_nvenc_available = False
+_nvenc_probe_failed_at: Optional[float] = None
+
+
+def _video_encoder() -> str:
+    """
+    Uses the NVENC hardware encoder when the GPU exposes it, libx264 otherwise.
+    A failed probe may be transient (e.g. all NVENC sessions busy), so it is retried
+    after NVENC_REPROBE_SECONDS instead of being cached for good.
+    """
+    global _nvenc_available, _nvenc_probe_failed_at
+    if _nvenc_available:
+        return "h264_nvenc"
+    if _nvenc_probe_failed_at is not None and time.monotonic() - _nvenc_probe_failed_at < NVENC_REPROBE_SECONDS:
+        return "libx264"
+    try:
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "nullsrc=s=256x256:d=0.1",
+             "-c:v", "h264_nvenc", "-f", "null", "-"],
+            capture_output=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        _nvenc_probe_failed_at = time.monotonic()
+        return "libx264"
+    _nvenc_available = True
+    return "h264_nvenc"
+
+
+def _run_ffmpeg(args: List[str]) -> subprocess.CompletedProcess:
+    """Runs an ffmpeg/ffprobe command, raising with its stderr on failure."""
+    result = subprocess.run(args, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{args[0]} exited with {result.returncode}: {result.stderr.strip()[-500:]}")
+    return result
+
+
+# Pending folder deletions as a min-heap of (expire_epoch, folder), drained by reaper_loop
+_reaper_heap: List[Tuple[float, str]] = []
+_reaper_lock = threading.Lock()
+_reaper_state_dir: Optional[str] = None
+_reaper_wakeup: Optional[asyncio.Event] = None
+_reaper_event_loop: Optional[asyncio.AbstractEventLoop] = None
 
 
 def _schedule_folder_deletion(folder: str, delay_seconds: float):
-    """Deletes a folder after a delay using a background timer."""
-    def _delete():
+    """Queues a folder for deletion by the reaper. Safe to call from worker threads."""
+    with _reaper_lock:
+        heapq.heappush(_reaper_heap, (time.time() + delay_seconds, folder))
+        _save_reaper_state()
+
+    if _reaper_event_loop is not None:
+        _reaper_event_loop.call_soon_threadsafe(_reaper_wakeup.set)
+
+
+def _reaper_state_path(pid: int) -> str:
+    # One file per process, so several uvicorn workers never overwrite each other's entries
+    return os.path.join(_reaper_state_dir, f".reaper.{pid}.json")
+
+
+def _save_reaper_state():
+    """Persists pending deletions so they survive restarts. Caller holds _reaper_lock."""
+    if _reaper_state_dir is None:
+        return
+    state_path = _reaper_state_path(os.getpid())
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(_reaper_heap, f)
+    os.replace(tmp_path, state_path)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load_reaper_state():
+    """
+    Adopts pending deletions from state files whose process is gone, including a previous
+    run with this same pid. Each file is claimed by renaming it, so only one worker loads it.
+    """
+    own_pid = os.getpid()
+    claim_path = os.path.join(_reaper_state_dir, f".reaper.{own_pid}.claim")
+
+    for name in os.listdir(_reaper_state_dir):
+        if not (name.startswith(".reaper.") and name.endswith(".json")):
+            continue
+        pid = name[len(".reaper."):-len(".json")]
+        if pid.isdigit() and int(pid) != own_pid and _pid_alive(int(pid)):
+            continue
+
+        try:
+            os.rename(os.path.join(_reaper_state_dir, name), claim_path)
+        except FileNotFoundError:
+            # Another worker claimed it first
+            continue
+        try:
+            with open(claim_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+
+        with _reaper_lock:
+            for expire_at, folder in entries:
+                heapq.heappush(_reaper_heap, (expire_at, folder))
+            _save_reaper_state()
+        os.remove(claim_path)
+
+
+def _pop_expired_folders() -> List[str]:
+    with _reaper_lock:
+        expired = []
+        now = time.time()
+        while _reaper_heap and _reaper_heap[0][0] <= now:
+            expired.append(heapq.heappop(_reaper_heap)[1])
+        if expired:
+            _save_reaper_state()
+        return expired
+
+
+def _delete_folders(folders: List[str]):
+    for folder in folders:
         if os.path.isdir(folder):
             shutil.rmtree(folder, ignore_errors=True)
 
-    timer = threading.Timer(delay_seconds, _delete)
-    timer.daemon = True
-    timer.start()
 
+async def reaper_loop(state_dir: str):
+    """
+    Background task (one per process) that deletes scheduled folders once they expire.
+    Sleeps until the earliest deadline or until a new deletion is scheduled.
+    Pending deletions are persisted to .reaper.<pid>.json files in state_dir.
+    """
+    global _reaper_state_dir, _reaper_wakeup, _reaper_event_loop
+    _reaper_state_dir = state_dir
+    _reaper_wakeup = asyncio.Event()
+    _reaper_event_loop = asyncio.get_running_loop()
+    # Both read and rewrite state files, so they run off the event loop
+    await _reaper_event_loop.run_in_executor(None, _load_reaper_state)
+
+    while True:
+        expired = await _reaper_event_loop.run_in_executor(None, _pop_expired_folders)
+        if expired:
+            await _reaper_event_loop.run_in_executor(None, _delete_folders, expired)
+
+        # Clear before reading the heap so a concurrent schedule is never missed
+        _reaper_wakeup.clear()
+        with _reaper_lock:
+            timeout = _reaper_heap[0][0] - time.time() if _reaper_heap else None
 
-def merge_video_audio(video_path: str, audio_path: str, output_path: str) -> str:
+        try:
+            await asyncio.wait_for(_reaper_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def merge_video_audio(video_path: str, audio_path: str, output_path: str) -> str:
     """
     Combines a video file with an audio file. The final video duration
     matches the audio duration — the video is trimmed or looped as needed.
+    Encodes with NVENC when available so the CPU stays free for the API.
 
     Args:
         video_path: Path to the video file.
@@ -68,15 +277,52 @@ def merge_video_audio(video_path: str, audio_path: str, output_path: str) -> str
     Returns:
         The output file path.
     """
-    audio = AudioFileClip(audio_path)
-    video = VideoFileClip(video_path)
+    duration = await _probe_duration(audio_path)
+    encoder = await asyncio.get_running_loop().run_in_executor(None, _video_encoder)
 
-    try:
-        video = video.with_duration(audio.duration)
-        video = video.with_audio(audio)
-        video.write_videofile(output_path, logger=None)
-    finally:
-        video.close()
-        audio.close()
+    # NVENC can still fail at runtime (e.g. the GPU's concurrent session limit), so retry on CPU
+    encoders = [encoder] if encoder == "libx264" else [encoder, "libx264"]
+    for attempt, encoder in enumerate(encoders):
+        if encoder == "h264_nvenc":
+            video_args = ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23"]
+        else:
+            video_args = ["-c:v", "libx264", "-crf", "23"]
+
+        try:
+            await _run_ffmpeg_async([
+                "ffmpeg", "-y", "-v", "error",
+                "-stream_loop", "-1", "-i", video_path,
+                "-i", audio_path,
+                "-map", "0:v:0", "-map", "1:a:0",
+                *video_args,
+                "-c:a", "aac",
+                "-t", f"{duration:.3f}",
+                output_path,
+            ])
+            break
+        except RuntimeError:
+            if attempt == len(encoders) - 1:
+                raise
 
     return output_path
+
+
+async def _probe_duration(path: str) -> float:
+    """Reads a media file's duration from its container header via ffprobe."""
+    stdout = await _run_ffmpeg_async([
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", path,
+    ])
+    return float(stdout.strip())
+
+
+async def _run_ffmpeg_async(args: List[str]) -> str:
+    """Runs an ffmpeg/ffprobe command without blocking the event loop, returning stdout."""
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"{args[0]} exited with {proc.returncode}: {stderr.decode().strip()[-500:]}")
+    return stdout.decode()